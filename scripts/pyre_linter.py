@@ -7,12 +7,27 @@ import os
 import subprocess
 import sys
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+
+# Responses are parsed with ujson when available. Output is always serialized with
+# the standard library, since ujson escapes forward slashes in paths by default.
+try:
+    from ujson import loads as _loads
+except ImportError:
+    from json import loads as _loads  # noqa
 
 
 LOG: logging.Logger = logging.getLogger(__name__)
 
+# Checked in order for every directory between a file and the filesystem root.
+_CONFIGURATION_NAMES: Tuple[str, ...] = (
+    ".pyre_configuration.local",
+    ".pyre_configuration",
+)
+
 
 class LintSeverity(str, Enum):
     ERROR = "error"
@@ -34,50 +49,85 @@ class LintMessage(NamedTuple):
     bypassChangedLineFiltering: Optional[bool]
 
 
-def _lint_paths(
-    checks: List[str], directory: str, paths: Iterable[str]
-) -> List[LintMessage]:
+def _quote_paths(paths: Iterable[str]) -> str:
+    # The query is parsed as Python, so `repr` gives correctly escaped literals.
+    return ",".join(map(repr, paths))
+
+
+def _lint_single(check: str, directory: str, quoted_paths: str) -> List[LintMessage]:
     messages = []
     try:
-        paths = [f"'{path}'" for path in paths]
-        for check in checks:
-            result = subprocess.run(
-                ["pyre", "query", f"run_check('{check}', {','.join(paths)})"],
-                check=True,
-                stdout=subprocess.PIPE,
-            )
-            response = json.loads(result.stdout.decode())
-            if "response" in response:
-                for error in response["response"]["errors"]:
-                    messages.append(
-                        LintMessage(
-                            path=error["path"],
-                            line=error["line"],
-                            char=error["column"],
-                            code="PYRELINT",
-                            severity=LintSeverity.WARNING,
-                            name=check,
-                            original=None,
-                            replacement=None,
-                            description=error["description"],
-                            bypassChangedLineFiltering=None,
-                        )
+        result = subprocess.run(
+            ["pyre", "query", f"run_check({check!r}, {quoted_paths})"],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        response = _loads(result.stdout)
+        if "response" in response:
+            for error in response["response"]["errors"]:
+                messages.append(
+                    LintMessage(
+                        path=error["path"],
+                        line=error["line"],
+                        char=error["column"],
+                        code="PYRELINT",
+                        severity=LintSeverity.WARNING,
+                        name=check,
+                        original=None,
+                        replacement=None,
+                        description=error["description"],
+                        bypassChangedLineFiltering=None,
                     )
+                )
     except subprocess.CalledProcessError as exception:
         LOG.error(str(exception))
-    except json.decoder.JSONDecodeError:
+    except ValueError:
         LOG.warning("Unable to decode server response.")
     return messages
 
 
+def _lint_paths(
+    checks: List[str], projects: Mapping[str, Iterable[str]]
+) -> List[LintMessage]:
+    # The server only parses a single call per `pyre query`, so checks cannot be
+    # combined into one request. Format each project's paths once and share them
+    # across its queries instead.
+    queries: List[Tuple[str, str, str]] = []
+    for directory, paths in projects.items():
+        quoted_paths = _quote_paths(paths)
+        queries.extend((check, directory, quoted_paths) for check in checks)
+    # Each query blocks on a `pyre` subprocess, so threads are enough to overlap them.
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = executor.map(lambda query: _lint_single(*query), queries)
+        return [message for messages in results for message in messages]
+
+
+def _has_pyre_configuration(directory: str) -> bool:
+    return any(
+        os.path.isfile(os.path.join(directory, name)) for name in _CONFIGURATION_NAMES
+    )
+
+
+# Maps every directory visited while looking for a configuration to its project.
+_project_cache: Dict[str, Optional[str]] = {}
+
+
 def _get_local_pyre_project(path: str) -> Optional[str]:
+    visited: List[str] = []
+    project = None
     while path != "/":
-        if os.path.isfile(f"{path}/.pyre_configuration.local") or os.path.isfile(
-            f"{path}/.pyre_configuration"
-        ):
-            return path
+        if path in _project_cache:
+            project = _project_cache[path]
+            break
+        visited.append(path)
+        if _has_pyre_configuration(path):
+            project = path
+            break
         path = os.path.dirname(path)
-    return None
+    for directory in visited:
+        _project_cache[directory] = project
+    return project
 
 
 def _group_by_pyre_server(paths: Iterable[str]) -> Mapping[str, List[str]]:
@@ -88,7 +138,8 @@ def _group_by_pyre_server(paths: Iterable[str]) -> Mapping[str, List[str]]:
     """
     file_mapping: Dict[str, List[str]] = defaultdict(list)
     for path in paths:
-        pyre_configuration = _get_local_pyre_project(path)
+        # Files sharing a directory resolve to the same project through the cache.
+        pyre_configuration = _get_local_pyre_project(os.path.dirname(path))
         if pyre_configuration is not None:
             file_mapping[pyre_configuration].append(path)
     return dict(file_mapping)
@@ -114,11 +165,12 @@ def main() -> None:
 
     paths = [os.path.abspath(filename) for filename in arguments.filenames]
     to_lint = _group_by_pyre_server(paths)
-    for directory in to_lint:
-        for result in _lint_paths(
-            checks=arguments.check, directory=directory, paths=to_lint[directory]
-        ):
-            print(json.dumps(result._asdict()))
+    sys.stdout.write(
+        "".join(
+            json.dumps(dict(zip(LintMessage._fields, result))) + "\n"
+            for result in _lint_paths(arguments.check, to_lint)
+        )
+    )
 
 
 if __name__ == "__main__":
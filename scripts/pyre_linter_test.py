@@ -5,17 +5,62 @@
 
 # pyre-strict
 
+import io
 import json
 import os.path  # noqa
 import subprocess
+import sys
 import unittest
 from collections import OrderedDict
-from unittest.mock import MagicMock, _patch, patch
+from typing import Callable, Iterable, List
+from unittest.mock import MagicMock, _patch, call, patch
 
-from .pyre_linter import _group_by_pyre_server, _lint_paths
+from . import pyre_linter
+from .pyre_linter import _group_by_pyre_server, _lint_paths, _project_cache, main
+
+
+def _isfile(files: Iterable[str]) -> Callable[[str], bool]:
+    existing = set(files)
+    return lambda path: path in existing
+
+
+class _UjsonLike:
+    """Stands in for ujson, which only raises a bare ValueError subclass."""
+
+    class JSONDecodeError(ValueError):
+        pass
+
+    @staticmethod
+    def loads(data: bytes) -> object:
+        if not isinstance(data, bytes):
+            raise TypeError("expected bytes")
+        try:
+            return json.loads(data.decode())
+        except json.JSONDecodeError as error:
+            raise _UjsonLike.JSONDecodeError(str(error))
+
+
+def _parsers() -> List[object]:
+    parsers: List[object] = [json, _UjsonLike]
+    try:
+        import ujson
+
+        parsers.append(ujson)
+    except ImportError:
+        pass
+    return parsers
+
+
+def _query_response(command: List[str], **kwargs: object) -> MagicMock:
+    # Reports a single error whose description is the query that produced it.
+    error = {"path": "x.py", "line": 1, "column": 2, "description": command[2]}
+    return MagicMock(stdout=json.dumps({"response": {"errors": [error]}}).encode())
 
 
 class PyreLinterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        _project_cache.clear()
+
     @patch(
         "subprocess.run",
         return_value=MagicMock(
@@ -42,12 +87,13 @@ class PyreLinterTest(unittest.TestCase):
         ),
     )
     def test_message_output_format(self, run: _patch) -> None:
-        results = _lint_paths(["awaitable"], "/root", ["/root/async_test.py"])
+        results = _lint_paths(["awaitable"], {"/root": ["/root/async_test.py"]})
         # pyre-ignore: Typeshed is missing the annotation.
         run.assert_called_once_with(
             ["pyre", "query", "run_check('awaitable', '/root/async_test.py')"],
             check=True,
             stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
         self.assertEqual(
             [result._asdict() for result in results],
@@ -69,14 +115,118 @@ class PyreLinterTest(unittest.TestCase):
             ],
         )
 
+    @patch("subprocess.run", return_value=MagicMock(stdout=b"{}"))
+    def test_quoted_check(self, run: _patch) -> None:
+        _lint_paths(["it's"], {"/root": ["/root/a.py"]})
+        # pyre-ignore: Typeshed is missing the annotation.
+        run.assert_called_once_with(
+            ["pyre", "query", "run_check(\"it's\", '/root/a.py')"],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    @patch("subprocess.run", return_value=MagicMock(stdout=b"{}"))
+    def test_quoted_paths(self, run: _patch) -> None:
+        _lint_paths(["awaitable"], {"/root": ["/root/a.py", "/root/it's.py"]})
+        # pyre-ignore: Typeshed is missing the annotation.
+        run.assert_called_once_with(
+            [
+                "pyre",
+                "query",
+                "run_check('awaitable', '/root/a.py',\"/root/it's.py\")",
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def test_response_parsers(self) -> None:
+        response = {"path": "a.py", "line": 1, "column": 2, "description": "d"}
+        valid = json.dumps({"response": {"errors": [response]}}).encode()
+        for parser in _parsers():
+            # pyre-ignore: `loads` is defined on every parser.
+            loads = parser.loads
+            with self.subTest(parser=parser), patch.object(
+                pyre_linter, "_loads", loads
+            ):
+                with patch("subprocess.run", return_value=MagicMock(stdout=valid)):
+                    messages = _lint_paths(["awaitable"], {"/root": ["/root/a.py"]})
+                self.assertEqual([message.path for message in messages], ["a.py"])
+                with patch(
+                    "subprocess.run", return_value=MagicMock(stdout=b"not json")
+                ):
+                    self.assertEqual(
+                        _lint_paths(["awaitable"], {"/root": ["/root/a.py"]}), []
+                    )
+
+    @patch("subprocess.run", side_effect=_query_response)
+    @patch(
+        "os.path.isfile",
+        side_effect=_isfile(["/a/.pyre_configuration", "/b/.pyre_configuration"]),
+    )
+    def test_main(self, isfile: _patch, run: _patch) -> None:
+        arguments = ["/a/x.py", "/b/y.py", "--check", "c1", "--check", "c2"]
+        output = io.StringIO()
+        with patch.object(sys, "argv", ["pyre_linter", *arguments]), patch.object(
+            sys, "stdout", output
+        ):
+            main()
+        queries = [
+            "run_check('c1', '/a/x.py')",
+            "run_check('c2', '/a/x.py')",
+            "run_check('c1', '/b/y.py')",
+            "run_check('c2', '/b/y.py')",
+        ]
+        # pyre-ignore: Typeshed is missing the annotation.
+        self.assertCountEqual(
+            run.call_args_list,
+            [
+                call(
+                    ["pyre", "query", query],
+                    check=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+                for query in queries
+            ],
+        )
+        # Messages are emitted by project, then by check, regardless of which
+        # query finishes first.
+        lines = output.getvalue().splitlines()
+        self.assertEqual([json.loads(line)["description"] for line in lines], queries)
+
+    @patch(
+        "subprocess.run",
+        return_value=MagicMock(
+            stdout=b'{"response": {"errors": [{"path": "/a/x.py", "line": 1, '
+            b'"column": 2, "description": "d"}]}}'
+        ),
+    )
+    @patch("os.path.isfile", side_effect=_isfile(["/a/.pyre_configuration"]))
+    def test_main_output(self, isfile: _patch, run: _patch) -> None:
+        output = io.StringIO()
+        with patch.object(
+            sys, "argv", ["pyre_linter", "/a/x.py", "--check", "c"]
+        ), patch.object(sys, "stdout", output):
+            main()
+        self.assertEqual(
+            output.getvalue(),
+            '{"path": "/a/x.py", "line": 1, "char": 2, "code": "PYRELINT", '
+            '"severity": "warning", "name": "c", "original": null, '
+            '"replacement": null, "description": "d", '
+            '"bypassChangedLineFiltering": null}\n',
+        )
+
     @patch(
         "os.path.isfile",
-        side_effect=lambda path: path
-        in {
-            "/a/.pyre_configuration",
-            "/b/c/.pyre_configuration.local",
-            "/b/.pyre_configuration.local",
-        },
+        side_effect=_isfile(
+            [
+                "/a/.pyre_configuration",
+                "/b/c/.pyre_configuration.local",
+                "/b/.pyre_configuration.local",
+            ]
+        ),
     )
     def test_group_by_pyre_server(self, isfile: _patch) -> None:
         self.assertEqual(_group_by_pyre_server(["/nonexistent/a.py"]), {})
@@ -88,3 +238,22 @@ class PyreLinterTest(unittest.TestCase):
             _group_by_pyre_server(["/b/c/x.py", "/b/c/y.py", "/b/a/first.py"]),
             {"/b/c": ["/b/c/x.py", "/b/c/y.py"], "/b": ["/b/a/first.py"]},
         )
+        # Files under a known project can still belong to a nested project.
+        self.assertEqual(
+            _group_by_pyre_server(["/b/c.py", "/b/c/x.py"]),
+            {"/b": ["/b/c.py"], "/b/c": ["/b/c/x.py"]},
+        )
+
+    @patch("os.path.isfile", side_effect=_isfile(["/a/.pyre_configuration"]))
+    def test_group_by_pyre_server_cache(self, isfile: _patch) -> None:
+        self.assertEqual(
+            _group_by_pyre_server(["/a/b/x.py", "/a/b/y.py"]),
+            {"/a": ["/a/b/x.py", "/a/b/y.py"]},
+        )
+        # `/a/b` and `/a` are only checked while resolving the first file.
+        # pyre-ignore: Typeshed is missing the annotation.
+        self.assertEqual(isfile.call_count, 4)
+        self.assertEqual(_group_by_pyre_server(["/nonexistent/a.py"]), {})
+        self.assertEqual(_group_by_pyre_server(["/nonexistent/b.py"]), {})
+        # pyre-ignore: Typeshed is missing the annotation.
+        self.assertEqual(isfile.call_count, 6)
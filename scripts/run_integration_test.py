@@ -2,7 +2,6 @@
 
 import argparse
 import filecmp
-import fileinput
 import json
 import logging
 import os
@@ -11,7 +10,9 @@ import shutil
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from typing import List, Optional, Tuple
 from zipfile import ZipFile
 
 
@@ -32,83 +33,116 @@ def assert_readable_directory(directory: str) -> None:
 def extract_typeshed(typeshed_zip_path: str, base_directory: str):
     typeshed = os.path.join(base_directory, "typeshed-master")
     os.mkdir(typeshed)
+    # Only extract the essential directories.
+    prefixes = ("typeshed-master/stdlib/", "typeshed-master/third_party/")
     with ZipFile(typeshed_zip_path, "r") as typeshed_zip:
-        typeshed_zip.extractall(base_directory)
+        for member in typeshed_zip.infolist():
+            if member.filename.startswith(prefixes):
+                typeshed_zip.extract(member, base_directory)
     assert_readable_directory(typeshed)
-    # Prune all non-essential directories.
-    for entry in os.listdir(typeshed):
-        if entry in ["stdlib", "third_party"]:
-            continue
-        full_path = os.path.join(typeshed, entry)
-        if os.path.isfile(full_path):
-            os.remove(full_path)
-        elif os.path.isdir(full_path):
-            shutil.rmtree(full_path)
     return typeshed
 
 
+def list_directory(
+    directory: str, ignored_files: List[str], ignored_directories: List[str]
+) -> Tuple[List[str], List[str]]:
+    """
+        Returns the names of the files and of the directories in `directory`,
+        using a single directory scan.
+    """
+    files = []
+    directories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                if entry.name not in ignored_files:
+                    files.append(entry.name)
+            elif entry.is_dir():
+                if entry.name not in ignored_directories:
+                    directories.append(entry.name)
+    return (files, directories)
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    # Commits are never modified in place, so sharing inodes with them is safe.
+    try:
+        os.link(source, destination)
+    except OSError:
+        # e.g. the repository and the temporary directory are on different devices.
+        shutil.copy2(source, destination)
+
+
+def files_match(
+    source_directory: str, destination_directory: str, filename: str
+) -> Optional[bool]:
+    """
+        Returns whether `filename` has the same contents in both directories, or
+        None if it cannot be read on either side.
+    """
+    try:
+        return filecmp.cmp(
+            os.path.join(source_directory, filename),
+            os.path.join(destination_directory, filename),
+            shallow=False,
+        )
+    except OSError:
+        return None
+
+
 def poor_mans_rsync(source_directory, destination_directory, ignored_files=None):
     ignored_files = ignored_files or []
     ignored_directories = [".pyre"]
     # Do not delete the server directory while copying!
     assert_readable_directory(source_directory)
-    source_files = [
-        entry
-        for entry in os.listdir(source_directory)
-        if entry not in ignored_files
-        and os.path.isfile(os.path.join(source_directory, entry))
-    ]
+    (source_files, source_directories) = list_directory(
+        source_directory, ignored_files, ignored_directories
+    )
     assert_readable_directory(destination_directory)
-    destination_files = [
-        entry
-        for entry in os.listdir(destination_directory)
-        if entry not in ignored_files
-        and os.path.isfile(os.path.join(destination_directory, entry))
-    ]
-    source_directories = [
-        entry
-        for entry in os.listdir(source_directory)
-        if os.path.isdir(os.path.join(source_directory, entry))
-        and entry not in ignored_directories
-    ]
-    destination_directories = [
-        entry
-        for entry in os.listdir(destination_directory)
-        if os.path.isdir(os.path.join(destination_directory, entry))
-        and entry not in ignored_directories
-    ]
-
-    # Copy all directories over blindly.
+    (destination_files, destination_directories) = list_directory(
+        destination_directory, ignored_files, ignored_directories
+    )
+
+    # Copy all directories over blindly. Existing entries are known from the scans
+    # above, so nothing needs to be stat'ed again before removing it.
+    existing_directories = set(destination_directories)
     for directory in source_directories:
         source = os.path.join(source_directory, directory)
         destination = os.path.join(destination_directory, directory)
-        if os.path.isdir(destination):
+        if directory in existing_directories:
             shutil.rmtree(destination)
-        shutil.copytree(source, destination)
+        shutil.copytree(source, destination, copy_function=link_or_copy)
 
     # Delete any missing directories.
-    for directory in destination_directories:
-        if directory not in source_directories:
-            destination = os.path.join(destination_directory, directory)
-            shutil.rmtree(destination)
-
-    for filename in destination_files:
-        if filename not in source_files:
-            LOG.info("Removing file '%s' from destination" % filename)
-            os.remove(os.path.join(destination_directory, filename))
-
-    # Compare files across source and destination.
-    (match, mismatch, error) = filecmp.cmpfiles(
-        source_directory, destination_directory, source_files, shallow=False
-    )
-    for filename in match:
-        LOG.info("Skipping file '%s' because it matches" % filename)
-    for filename in mismatch:
-        LOG.info("Copying file '%s' due to mismatch" % filename)
-        shutil.copy2(os.path.join(source_directory, filename), destination_directory)
-    for filename in error:
-        LOG.info("Copying file '%s' because it is missing" % filename)
-        shutil.copy2(os.path.join(source_directory, filename), destination_directory)
+    for directory in existing_directories.difference(source_directories):
+        destination = os.path.join(destination_directory, directory)
+        shutil.rmtree(destination)
+
+    for filename in set(destination_files).difference(source_files):
+        LOG.info("Removing file '%s' from destination" % filename)
+        os.remove(os.path.join(destination_directory, filename))
+
+    # Compare files across source and destination. Comparisons are IO-bound, so
+    # read them concurrently.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        comparisons = list(
+            executor.map(
+                lambda filename: files_match(
+                    source_directory, destination_directory, filename
+                ),
+                source_files,
+            )
+        )
+    for filename, match in zip(source_files, comparisons):
+        if match is None:
+            LOG.info("Copying file '%s' because it is missing" % filename)
+            source = os.path.join(source_directory, filename)
+            shutil.copy2(source, destination_directory)
+        elif match:
+            LOG.info("Skipping file '%s' because it matches" % filename)
+        else:
+            LOG.info("Copying file '%s' due to mismatch" % filename)
+            source = os.path.join(source_directory, filename)
+            shutil.copy2(source, destination_directory)
 
 
 class Repository:
@@ -118,14 +152,23 @@ class Repository:
         self._test_typeshed_location = extract_typeshed(
             typeshed_zip_path, base_directory
         )
+        self._pyre_client = os.getenv("PYRE_TEST_CLIENT_LOCATION", "pyre")
+        self._pyre_base_arguments = [
+            self._pyre_client,
+            "--noninteractive",
+            "--show-parse-errors",
+            "--output=json",
+        ]
+        # Only the client's stdout is inspected. Verbose runs show stderr as it is
+        # written; otherwise it is captured and only logged when the client fails.
+        self._pyre_stderr = None if LOG.isEnabledFor(logging.DEBUG) else subprocess.PIPE
 
         # Parse list of fake commits.
         assert_readable_directory(repository_path)
         self._base_repository_path = os.path.realpath(repository_path)
-        commits_list = os.listdir(self._base_repository_path)
-        list.sort(commits_list)
-        for commit in commits_list:
-            assert_readable_directory(os.path.join(self._base_repository_path, commit))
+        # Each commit is still checked for readability when it is copied.
+        with os.scandir(self._base_repository_path) as entries:
+            commits_list = sorted(entry.name for entry in entries if entry.is_dir())
         self._commits_list = iter(commits_list)
 
         # Move into the temporary repository directory.
@@ -167,14 +210,11 @@ class Repository:
         poor_mans_rsync(original_path, destination_path)
 
     def _resolve_typeshed_location(self, filename):
-        with fileinput.input(filename, inplace=True) as f:
-            for line in f:
-                print(
-                    line.replace(
-                        "PYRE_TEST_TYPESHED_LOCATION", self._test_typeshed_location
-                    ),
-                    end="",
-                )
+        path = pathlib.Path(filename)
+        typeshed_location = os.fsencode(self._test_typeshed_location)
+        path.write_bytes(
+            path.read_bytes().replace(b"PYRE_TEST_TYPESHED_LOCATION", typeshed_location)
+        )
 
     def get_pyre_errors(self):
         # Run the full check first so that watchman updates have time to propagate.
@@ -182,24 +222,21 @@ class Repository:
         incremental_errors = self.run_pyre("incremental")
         return (incremental_errors, check_errors)
 
-    def run_pyre(self, command: str, *arguments: str) -> str:
-        pyre_client = os.getenv("PYRE_TEST_CLIENT_LOCATION", "pyre")
+    def run_pyre(self, command: str, *arguments: str) -> bytes:
         try:
             output = subprocess.check_output(
-                [
-                    pyre_client,
-                    "--noninteractive",
-                    "--show-parse-errors",
-                    "--output=json",
-                    command,
-                    *arguments,
-                ]
+                [*self._pyre_base_arguments, command, *arguments],
+                stderr=self._pyre_stderr,
             )
         except subprocess.CalledProcessError as error:
             if error.returncode not in [0, 1]:
+                if error.stderr:
+                    LOG.error(
+                        "`pyre %s` failed:\n%s", command, error.stderr.decode("utf-8")
+                    )
                 raise error
             output = error.output
-        return output.decode("utf-8")
+        return output
 
 
 def run_integration_test(
@@ -224,17 +261,25 @@ def run_integration_test(
                 repository.run_pyre("stop")
             except Exception as uncaught_pyre_exception:
                 LOG.error("Uncaught exception: `%s`", str(uncaught_pyre_exception))
-                LOG.info("Pyre rage: %s", repository.run_pyre("rage"))
+                LOG.info("Pyre rage: %s", repository.run_pyre("rage").decode("utf-8"))
                 raise uncaught_pyre_exception
 
         if discrepancies:
             LOG.error("Pyre rage:")
-            print(repository.run_pyre("rage"), file=sys.stderr)
+            print(repository.run_pyre("rage").decode("utf-8"), file=sys.stderr)
             LOG.error("Found discrepancies between incremental and complete checks!")
             for revision, (actual_error, expected_error) in discrepancies.items():
                 print("Difference found for revision: {}".format(revision))
-                print("Actual errors (pyre incremental): {}".format(actual_error))
-                print("Expected errors (pyre check): {}".format(expected_error))
+                print(
+                    "Actual errors (pyre incremental): {}".format(
+                        actual_error.decode("utf-8")
+                    )
+                )
+                print(
+                    "Expected errors (pyre check): {}".format(
+                        expected_error.decode("utf-8")
+                    )
+                )
             return 1
 
     return 0
@@ -268,8 +313,12 @@ def run_saved_state_test(typeshed_zip_path: str, repository_path: str) -> int:
 
     if actual_errors != expected_errors:
         LOG.error("Actual errors are not equal to expected errors.")
-        print("Actual errors (pyre incremental): {}".format(actual_errors))
-        print("Expected errors (pyre check): {}".format(expected_errors))
+        print(
+            "Actual errors (pyre incremental): {}".format(actual_errors.decode("utf-8"))
+        )
+        print(
+            "Expected errors (pyre check): {}".format(expected_errors.decode("utf-8"))
+        )
         return 1
     return 0
 
@@ -290,9 +339,6 @@ def _watch_directory(source_directory):
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO, format=" >>> %(asctime)s %(levelname)s %(message)s"
-    )
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "repository_location", help="Path to directory with fake commit list"
@@ -303,7 +349,17 @@ if __name__ == "__main__":
         type=os.path.abspath,
     )
     parser.add_argument("--debug", action="store_true", default=False)
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Log debug messages and show the output of the pyre client on stderr.",
+    )
     arguments = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if arguments.verbose else logging.INFO,
+        format=" >>> %(asctime)s %(levelname)s %(message)s",
+    )
     retries = 3
     typeshed_zip_path = arguments.typeshed_zip_path or str(
         pathlib.Path.cwd() / "stubs/typeshed/typeshed.zip"